@@ -4,28 +4,132 @@ Authentication module for the AI Chatbot
 Handles user registration, login, and session management
 """
 
+import base64
 import bcrypt
 import hashlib
+import hmac
 import os
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from functools import wraps
-from flask import session, redirect, url_for, flash
+from flask import g, session, redirect, url_for, flash
 
 # Database path
 DATABASE_PATH = os.getenv("DATABASE_PATH", "chatbot.db")
 
+# Bcrypt work factor (log2 of the key-schedule rounds, each step doubles the cost)
+# Rough timings per hash: 10 ~ 75ms, 11 ~ 155ms, 12 ~ 300ms
+BCRYPT_COST = int(os.getenv("BCRYPT_COST", "10"))
+
+# Bind the bcrypt primitives once to avoid attribute lookups on hot paths
+_HASHPW = bcrypt.hashpw
+_CHECKPW = bcrypt.checkpw
+_GENSALT = bcrypt.gensalt
+
+# Number of worker processes for bcrypt calls (0 runs them in the calling thread).
+# The threaded server already overlaps bcrypt since it releases the GIL; a pool
+# helps when many greenlets share one OS thread, e.g. gunicorn with gevent
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", "0"))
+_bcrypt_pool = None
+_bcrypt_pool_lock = threading.Lock()
+
+def _run_bcrypt(func, *args):
+    """Run a bcrypt primitive, offloading it to the process pool if enabled"""
+    global _bcrypt_pool
+    if BCRYPT_WORKERS <= 0:
+        return func(*args)
+    if _bcrypt_pool is None:
+        with _bcrypt_pool_lock:
+            if _bcrypt_pool is None:
+                _bcrypt_pool = ProcessPoolExecutor(max_workers=BCRYPT_WORKERS)
+    return _bcrypt_pool.submit(func, *args).result()
+
+# bcrypt silently ignores everything past the first 72 bytes of a password
+BCRYPT_MAX_PASSWORD_BYTES = 72
+
+def _bcrypt_input(password):
+    """Encode a password for bcrypt, pre-hashing it if it is too long"""
+    pw = password.encode('utf-8') if isinstance(password, str) else password
+    if len(pw) > BCRYPT_MAX_PASSWORD_BYTES:
+        # Fold long passwords into a fixed-size digest so no characters are dropped
+        pw = base64.b64encode(hashlib.sha256(pw).digest())
+    return pw
+
+# SQL statements used by AuthManager
+SQL_UPDATE_PASSWORD = "UPDATE users_auth SET password_hash = ? WHERE id = ?"
+SQL_FIND_EXISTING_USER = """
+    SELECT id FROM users_auth
+    WHERE username = ? OR email = ?
+"""
+SQL_INSERT_USER = """
+    INSERT INTO users_auth (username, email, password_hash)
+    VALUES (?, ?, ?)
+"""
+SQL_INSERT_PROFILE = """
+    INSERT INTO user_profiles (user_id, display_name)
+    VALUES (?, ?)
+"""
+SQL_FIND_USER = """
+    SELECT id, username, password_hash FROM users_auth
+    WHERE username = ? AND is_active = 1
+"""
+SQL_UPDATE_LAST_LOGIN = """
+    UPDATE users_auth SET last_login = datetime('now')
+    WHERE id = ?
+"""
+SQL_GET_USER_BY_ID = """
+    SELECT ua.id, ua.username, ua.email, ua.created_at, ua.last_login,
+           up.display_name, up.avatar_url, up.preferences
+    FROM users_auth ua
+    LEFT JOIN user_profiles up ON ua.id = up.user_id
+    WHERE ua.id = ? AND ua.is_active = 1
+"""
+SQL_UPDATE_PROFILE = """
+    UPDATE user_profiles
+    SET display_name = COALESCE(?, display_name),
+        avatar_url = COALESCE(?, avatar_url),
+        preferences = COALESCE(?, preferences),
+        updated_at = datetime('now')
+    WHERE user_id = ?
+"""
+SQL_GET_PASSWORD_HASH = "SELECT password_hash FROM users_auth WHERE id = ?"
+
+# Successful bcrypt verifications are remembered for a short time so that
+# repeated logins with the same credentials skip the expensive hash check
+VERIFY_CACHE_TTL = int(os.getenv("VERIFY_CACHE_TTL", "300"))
+VERIFY_CACHE_SIZE = 1024
+
 class AuthManager:
     """Manages user authentication and authorization"""
     
     def __init__(self, db_path=DATABASE_PATH):
         self.db_path = db_path
+        self._verify_cache = OrderedDict()
+        self._verify_cache_lock = threading.Lock()
+        self._local = threading.local()
         self.init_auth_tables()
     
+    def _get_conn(self):
+        """Get this thread's database connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            conn.execute('PRAGMA cache_size=-20000')
+            conn.execute('PRAGMA mmap_size=268435456')  # Read pages via mmap, up to 256MB
+            self._local.conn = conn
+        return conn
+    
     def init_auth_tables(self):
         """Initialize authentication tables"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._get_conn() as conn:
                 cursor = conn.cursor()
                 
                 # Create users_auth table for authentication
@@ -34,7 +138,7 @@ class AuthManager:
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
                         username TEXT UNIQUE NOT NULL,
                         email TEXT UNIQUE NOT NULL,
-                        password_hash TEXT NOT NULL,
+                        password_hash BLOB NOT NULL,
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         last_login TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         is_active BOOLEAN DEFAULT 1
@@ -55,6 +159,16 @@ class AuthManager:
                     )
                 ''')
                 
+                # Indexes for login lookups and the profile JOIN
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_users_auth_username_active
+                    ON users_auth(username, is_active) WHERE is_active = 1
+                ''')
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_user_profiles_user_id
+                    ON user_profiles(user_id)
+                ''')
+                
                 conn.commit()
                 print("✅ Authentication tables initialized")
                 
@@ -63,37 +177,80 @@ class AuthManager:
     
     def hash_password(self, password):
         """Hash a password using bcrypt"""
-        salt = bcrypt.gensalt()
-        return bcrypt.hashpw(password.encode('utf-8'), salt)
+        salt = _GENSALT(rounds=BCRYPT_COST)
+        return _run_bcrypt(_HASHPW, _bcrypt_input(password), salt)
     
     def verify_password(self, password, password_hash):
         """Verify a password against its hash"""
         try:
-            return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+            pw = password.encode('utf-8') if isinstance(password, str) else password
+            ph = password_hash.encode('utf-8') if isinstance(password_hash, str) else password_hash
+            return _run_bcrypt(_CHECKPW, _bcrypt_input(pw), ph)
+        except Exception:
+            return False
+    
+    def verify_truncated_password(self, password, password_hash):
+        """Verify a long password against a hash made before pre-hashing was added"""
+        try:
+            pw = password.encode('utf-8') if isinstance(password, str) else password
+            ph = password_hash.encode('utf-8') if isinstance(password_hash, str) else password_hash
+            # Those hashes only cover the first 72 bytes
+            return len(pw) > BCRYPT_MAX_PASSWORD_BYTES and _run_bcrypt(_CHECKPW, pw[:BCRYPT_MAX_PASSWORD_BYTES], ph)
         except Exception:
             return False
     
+    def _verify_cache_key(self, username, password, password_hash):
+        """Build a cache key that never keeps the plaintext password around"""
+        material = f"{username}:{password}:{password_hash}"
+        return hashlib.sha256(material.encode('utf-8')).digest()
+    
+    def _is_verified_cached(self, key):
+        """Check whether a successful verification is cached and still fresh"""
+        with self._verify_cache_lock:
+            expiry = self._verify_cache.get(key)
+            if expiry is None:
+                return False
+            if expiry < time.monotonic():
+                del self._verify_cache[key]
+                return False
+            self._verify_cache.move_to_end(key)
+            return True
+    
+    def _remember_verified(self, key):
+        """Cache a successful verification (failures are never cached)"""
+        with self._verify_cache_lock:
+            self._verify_cache[key] = time.monotonic() + VERIFY_CACHE_TTL
+            self._verify_cache.move_to_end(key)
+            while len(self._verify_cache) > VERIFY_CACHE_SIZE:
+                self._verify_cache.popitem(last=False)
+    
+    def is_bcrypt_hash(self, password_hash):
+        """Check whether a stored hash is in bcrypt format ($2a$, $2b$, $2y$)"""
+        prefix = b'$2' if isinstance(password_hash, bytes) else '$2'
+        return password_hash.startswith(prefix)
+    
     def verify_legacy_password(self, password, password_hash):
         """Verify a password against legacy SHA-256 hash"""
         try:
-            legacy_hash = hashlib.sha256(password.encode()).hexdigest()
-            return legacy_hash == password_hash
+            # Constant-time comparison of the raw digests
+            legacy_digest = hashlib.sha256(password.encode()).digest()
+            if isinstance(password_hash, bytes):
+                password_hash = password_hash.decode('ascii')
+            return hmac.compare_digest(legacy_digest, bytes.fromhex(password_hash))
         except Exception:
             return False
     
     def migrate_password(self, user_id, password):
-        """Migrate a user's password from SHA-256 to bcrypt"""
+        """Rehash a user's password (legacy SHA-256 or truncated bcrypt) with the current scheme"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._get_conn() as conn:
                 cursor = conn.cursor()
                 
                 # Hash with bcrypt
                 new_hash = self.hash_password(password)
                 
-                # Update the password hash
-                cursor.execute('''
-                    UPDATE users_auth SET password_hash = ? WHERE id = ?
-                ''', (new_hash.decode('utf-8'), user_id))
+                # Update the password hash (stored as raw bytes)
+                cursor.execute(SQL_UPDATE_PASSWORD, (new_hash, user_id))
                 
                 conn.commit()
                 print(f"✅ Migrated password for user {user_id}")
@@ -106,35 +263,24 @@ class AuthManager:
     def register_user(self, username, email, password):
         """Register a new user"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._get_conn() as conn:
                 cursor = conn.cursor()
                 
                 # Check if username or email already exists
-                cursor.execute('''
-                    SELECT id FROM users_auth 
-                    WHERE username = ? OR email = ?
-                ''', (username, email))
+                cursor.execute(SQL_FIND_EXISTING_USER, (username, email))
                 
                 if cursor.fetchone():
                     return False, "Username or email already exists"
                 
-                # Hash password and create user
+                # Hash password and create user (the hash is stored as raw bytes)
                 password_hash = self.hash_password(password)
-                # Convert bytes to string for database storage
-                password_hash_str = password_hash.decode('utf-8')
                 
-                cursor.execute('''
-                    INSERT INTO users_auth (username, email, password_hash)
-                    VALUES (?, ?, ?)
-                ''', (username, email, password_hash_str))
+                cursor.execute(SQL_INSERT_USER, (username, email, password_hash))
                 
                 user_id = cursor.lastrowid
                 
                 # Create user profile
-                cursor.execute('''
-                    INSERT INTO user_profiles (user_id, display_name)
-                    VALUES (?, ?)
-                ''', (user_id, username))
+                cursor.execute(SQL_INSERT_PROFILE, (user_id, username))
                 
                 conn.commit()
                 return True, f"User {username} registered successfully"
@@ -146,13 +292,10 @@ class AuthManager:
     def login_user(self, username, password):
         """Authenticate a user"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._get_conn() as conn:
                 cursor = conn.cursor()
                 
-                cursor.execute('''
-                    SELECT id, username, password_hash FROM users_auth 
-                    WHERE username = ? AND is_active = 1
-                ''', (username,))
+                cursor.execute(SQL_FIND_USER, (username,))
                 
                 user = cursor.fetchone()
                 
@@ -160,28 +303,43 @@ class AuthManager:
                     user_id, username, password_hash = user
                     print(f"🔍 Attempting login for user: {username}")
                     
-                    # Try bcrypt verification first
-                    if self.verify_password(password, password_hash):
+                    cache_key = self._verify_cache_key(username, password, password_hash)
+                    is_bcrypt = self.is_bcrypt_hash(password_hash)
+                    
+                    # Skip bcrypt entirely for recently verified credentials
+                    if self._is_verified_cached(cache_key):
+                        print(f"✅ Cached verification successful for user: {username}")
+                        cursor.execute(SQL_UPDATE_LAST_LOGIN, (user_id,))
+                        
+                        conn.commit()
+                        return True, user_id, username
+                    
+                    # Bcrypt hashes are verified with bcrypt only
+                    elif is_bcrypt and self.verify_password(password, password_hash):
                         print(f"✅ Bcrypt verification successful for user: {username}")
+                        self._remember_verified(cache_key)
                         # Update last login
-                        cursor.execute('''
-                            UPDATE users_auth SET last_login = datetime('now')
-                            WHERE id = ?
-                        ''', (user_id,))
+                        cursor.execute(SQL_UPDATE_LAST_LOGIN, (user_id,))
                         
                         conn.commit()
                         return True, user_id, username
                     
-                    # If bcrypt fails, try legacy SHA-256 verification
-                    elif self.verify_legacy_password(password, password_hash):
+                    # Long passwords hashed before pre-hashing were truncated; rehash them once
+                    elif is_bcrypt and self.verify_truncated_password(password, password_hash):
+                        print(f"✅ Truncated bcrypt verification successful for user: {username}")
+                        if self.migrate_password(user_id, password):
+                            cursor.execute(SQL_UPDATE_LAST_LOGIN, (user_id,))
+                            
+                            conn.commit()
+                            return True, user_id, username
+                    
+                    # Anything else is a legacy SHA-256 hex digest
+                    elif not is_bcrypt and self.verify_legacy_password(password, password_hash):
                         print(f"✅ Legacy SHA-256 verification successful for user: {username}")
                         # Migrate password to bcrypt
                         if self.migrate_password(user_id, password):
                             # Update last login
-                            cursor.execute('''
-                                UPDATE users_auth SET last_login = datetime('now')
-                                WHERE id = ?
-                            ''', (user_id,))
+                            cursor.execute(SQL_UPDATE_LAST_LOGIN, (user_id,))
                             
                             conn.commit()
                             return True, user_id, username
@@ -199,16 +357,10 @@ class AuthManager:
     def get_user_by_id(self, user_id):
         """Get user information by ID"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._get_conn() as conn:
                 cursor = conn.cursor()
                 
-                cursor.execute('''
-                    SELECT ua.id, ua.username, ua.email, ua.created_at, ua.last_login,
-                           up.display_name, up.avatar_url, up.preferences
-                    FROM users_auth ua
-                    LEFT JOIN user_profiles up ON ua.id = up.user_id
-                    WHERE ua.id = ? AND ua.is_active = 1
-                ''', (user_id,))
+                cursor.execute(SQL_GET_USER_BY_ID, (user_id,))
                 
                 user = cursor.fetchone()
                 if user:
@@ -231,18 +383,11 @@ class AuthManager:
     def update_user_profile(self, user_id, display_name=None, avatar_url=None, preferences=None):
         """Update user profile information"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._get_conn() as conn:
                 cursor = conn.cursor()
                 
                 if display_name or avatar_url or preferences:
-                    cursor.execute('''
-                        UPDATE user_profiles 
-                        SET display_name = COALESCE(?, display_name),
-                            avatar_url = COALESCE(?, avatar_url),
-                            preferences = COALESCE(?, preferences),
-                            updated_at = datetime('now')
-                        WHERE user_id = ?
-                    ''', (display_name, avatar_url, preferences, user_id))
+                    cursor.execute(SQL_UPDATE_PROFILE, (display_name, avatar_url, preferences, user_id))
                     
                     conn.commit()
                     return True
@@ -255,27 +400,24 @@ class AuthManager:
     def change_password(self, user_id, old_password, new_password):
         """Change user password"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._get_conn() as conn:
                 cursor = conn.cursor()
                 
                 # Get current password hash
-                cursor.execute('''
-                    SELECT password_hash FROM users_auth WHERE id = ?
-                ''', (user_id,))
+                cursor.execute(SQL_GET_PASSWORD_HASH, (user_id,))
                 
                 current_hash = cursor.fetchone()
                 if not current_hash:
                     return False, "User not found"
                 
                 # Verify old password
-                if not self.verify_password(old_password, current_hash[0]):
+                if not (self.verify_password(old_password, current_hash[0])
+                        or self.verify_truncated_password(old_password, current_hash[0])):
                     return False, "Current password is incorrect"
                 
                 # Update password
                 new_hash = self.hash_password(new_password)
-                cursor.execute('''
-                    UPDATE users_auth SET password_hash = ? WHERE id = ?
-                ''', (new_hash, user_id))
+                cursor.execute(SQL_UPDATE_PASSWORD, (new_hash, user_id))
                 
                 conn.commit()
                 return True, "Password changed successfully"
@@ -298,16 +440,21 @@ def login_required(f):
     return decorated_function
 
 def get_current_user():
-    """Get current user information"""
+    """Get current user information (looked up at most once per request)"""
+    if 'current_user' in g:
+        return g.current_user
+    
+    current_user = None
     if 'user_id' in session:
         user_id = session['user_id']
         
         # Handle prefixed user IDs (auth_user_123)
         if isinstance(user_id, str) and user_id.startswith('auth_user_'):
             actual_user_id = int(user_id.replace('auth_user_', ''))
-            return auth_manager.get_user_by_id(actual_user_id)
+            current_user = auth_manager.get_user_by_id(actual_user_id)
         elif isinstance(user_id, int):
             # Legacy case: direct integer user ID
-            return auth_manager.get_user_by_id(user_id)
+            current_user = auth_manager.get_user_by_id(user_id)
     
-    return None 
\ No newline at end of file
+    g.current_user = current_user
+    return current_user 
\ No newline at end of file
@@ -6,12 +6,24 @@ Provides functions for database backup, restore, and maintenance.
 
 import sqlite3
 import os
-import shutil
-import json
+import orjson
 from datetime import datetime
 import argparse
 
 DATABASE_PATH = os.getenv("DATABASE_PATH", "chatbot.db")
+BACKUP_PAGES_PER_STEP = 1000
+EXPORT_BATCH_SIZE = 1000
+
+def _copy_database(source_path, target_path):
+    """Copy a live database with SQLite's online backup API"""
+    src = sqlite3.connect(source_path)
+    dst = sqlite3.connect(target_path)
+    try:
+        # Copying in chunks lets other writers get in between steps
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP)
+    finally:
+        dst.close()
+        src.close()
 
 def backup_database(backup_path=None):
     """Create a backup of the database"""
@@ -21,7 +33,7 @@ def backup_database(backup_path=None):
     
     try:
         if os.path.exists(DATABASE_PATH):
-            shutil.copy2(DATABASE_PATH, backup_path)
+            _copy_database(DATABASE_PATH, backup_path)
             print(f"✅ Database backed up to: {backup_path}")
             return True
         else:
@@ -35,7 +47,7 @@ def restore_database(backup_path):
     """Restore database from backup"""
     try:
         if os.path.exists(backup_path):
-            shutil.copy2(backup_path, DATABASE_PATH)
+            _copy_database(backup_path, DATABASE_PATH)
             print(f"✅ Database restored from: {backup_path}")
             return True
         else:
@@ -51,24 +63,16 @@ def get_database_stats():
         with sqlite3.connect(DATABASE_PATH) as conn:
             cursor = conn.cursor()
             
-            # Get user count
-            cursor.execute("SELECT COUNT(*) FROM users")
-            user_count = cursor.fetchone()[0]
-            
-            # Get conversation count
-            cursor.execute("SELECT COUNT(*) FROM conversations")
-            conversation_count = cursor.fetchone()[0]
-            
-            # Get message count
-            cursor.execute("SELECT COUNT(*) FROM messages")
-            message_count = cursor.fetchone()[0]
-            
-            # Get recent activity
+            # Get all counts and recent activity in one query
             cursor.execute("""
-                SELECT COUNT(*) FROM users 
-                WHERE last_active > datetime('now', '-7 days')
+                SELECT
+                    (SELECT COUNT(*) FROM users),
+                    (SELECT COUNT(*) FROM conversations),
+                    (SELECT COUNT(*) FROM messages),
+                    (SELECT COUNT(*) FROM users
+                     WHERE last_active > datetime('now', '-7 days'))
             """)
-            active_users = cursor.fetchone()[0]
+            user_count, conversation_count, message_count, active_users = cursor.fetchone()
             
             print("📊 Database Statistics:")
             print(f"   Users: {user_count}")
@@ -86,6 +90,14 @@ def get_database_stats():
         print(f"❌ Error getting database stats: {e}")
         return None
 
+def _iter_rows(cursor, batch_size=EXPORT_BATCH_SIZE):
+    """Yield cursor rows in batches without loading the full result"""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield from rows
+
 def export_user_data(user_id, output_file=None):
     """Export user data to JSON"""
     try:
@@ -100,56 +112,65 @@ def export_user_data(user_id, output_file=None):
                 print(f"❌ User {user_id} not found")
                 return False
             
-            # Get user conversations
-            cursor.execute("""
-                SELECT conversation_id, title, model, created_at, updated_at
-                FROM conversations WHERE user_id = ?
-                ORDER BY updated_at DESC
-            """, (user_id,))
-            conversations = cursor.fetchall()
-            
-            # Get messages for each conversation
-            user_data = {
+            user_info = {
                 'user_id': user[1],
                 'username': user[2],
                 'created_at': user[3],
-                'last_active': user[4],
-                'conversations': []
+                'last_active': user[4]
             }
             
-            for conv in conversations:
-                conversation_data = {
-                    'conversation_id': conv[0],
-                    'title': conv[1],
-                    'model': conv[2],
-                    'created_at': conv[3],
-                    'updated_at': conv[4],
-                    'messages': []
-                }
-                
-                # Get messages for this conversation
-                cursor.execute("""
-                    SELECT role, content, model, timestamp
-                    FROM messages WHERE conversation_id = ?
-                    ORDER BY timestamp ASC
-                """, (conv[0],))
-                
-                messages = cursor.fetchall()
-                for msg in messages:
-                    conversation_data['messages'].append({
-                        'role': msg[0],
-                        'content': msg[1],
-                        'model': msg[2],
-                        'timestamp': msg[3]
-                    })
-                
-                user_data['conversations'].append(conversation_data)
+            # Get all conversations and their messages in a single query
+            cursor.execute("""
+                SELECT c.conversation_id, c.title, c.model, c.created_at, c.updated_at,
+                       m.role, m.content, m.model, m.timestamp
+                FROM conversations c
+                LEFT JOIN messages m ON m.conversation_id = c.conversation_id
+                WHERE c.user_id = ?
+                ORDER BY c.updated_at DESC, c.conversation_id, m.timestamp ASC, m.id ASC
+            """, (user_id,))
             
             if not output_file:
                 output_file = f"user_{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
             
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(user_data, f, indent=2, ensure_ascii=False)
+            # Write compact JSON incrementally so memory use does not grow with history size.
+            # Each object is encoded with orjson and left open to append its nested list
+            with open(output_file, 'wb') as f:
+                f.write(orjson.dumps(user_info)[:-1] + b',"conversations":[')
+                
+                current_id = None
+                message_count = 0
+                for row in _iter_rows(cursor):
+                    if row[0] != current_id:
+                        if current_id is not None:
+                            f.write(b']},')
+                        current_id = row[0]
+                        message_count = 0
+                        
+                        conversation_info = {
+                            'conversation_id': row[0],
+                            'title': row[1],
+                            'model': row[2],
+                            'created_at': row[3],
+                            'updated_at': row[4]
+                        }
+                        f.write(orjson.dumps(conversation_info)[:-1] + b',"messages":[')
+                    
+                    # Conversations without messages come back with NULL message columns
+                    if row[5] is None:
+                        continue
+                    
+                    message = {
+                        'role': row[5],
+                        'content': row[6],
+                        'model': row[7],
+                        'timestamp': row[8]
+                    }
+                    if message_count:
+                        f.write(b',')
+                    f.write(orjson.dumps(message))
+                    message_count += 1
+                
+                f.write(b']}]}' if current_id is not None else b']}')
             
             print(f"✅ User data exported to: {output_file}")
             return True
@@ -159,41 +180,69 @@ def export_user_data(user_id, output_file=None):
         return False
 
 def cleanup_old_data(days=30):
-    """Clean up old data (users inactive for specified days)"""
+    """Clean up old data (anonymous and legacy users inactive for specified days)
+
+    Registered (auth_user_*) accounts and their conversations are never removed here.
+    """
     try:
         with sqlite3.connect(DATABASE_PATH) as conn:
             cursor = conn.cursor()
+            cutoff = f"-{int(days)} days"
             
-            # Get inactive users
+            # Count inactive users; registered accounts are kept regardless of activity
             cursor.execute("""
-                SELECT user_id FROM users 
-                WHERE last_active < datetime('now', '-{} days')
-            """.format(days))
+                SELECT COUNT(*) FROM users 
+                WHERE last_active < datetime('now', ?)
+                  AND user_id NOT LIKE 'auth\\_user\\_%' ESCAPE '\\'
+            """, (cutoff,))
             
-            inactive_users = cursor.fetchall()
+            inactive_count = cursor.fetchone()[0]
+            
+            # Anonymous users have no users row, so their conversations expire on their own activity
+            cursor.execute("""
+                DELETE FROM messages WHERE conversation_id IN (
+                    SELECT conversation_id FROM conversations
+                    WHERE user_id LIKE 'anon\\_user\\_%' ESCAPE '\\' AND updated_at < datetime('now', ?)
+                )
+            """, (cutoff,))
+            cursor.execute("""
+                DELETE FROM conversations
+                WHERE user_id LIKE 'anon\\_user\\_%' ESCAPE '\\' AND updated_at < datetime('now', ?)
+            """, (cutoff,))
+            anonymous_count = cursor.rowcount
+            conn.commit()
             
-            if not inactive_users:
+            if anonymous_count:
+                print(f"✅ Cleaned up {anonymous_count} inactive anonymous conversations")
+            
+            if not inactive_count:
                 print(f"✅ No users inactive for {days} days")
                 return True
             
-            print(f"🗑️  Found {len(inactive_users)} inactive users")
+            print(f"🗑️  Found {inactive_count} inactive users")
             
-            for user in inactive_users:
-                user_id = user[0]
-                print(f"   Deleting user: {user_id}")
-                
-                # Delete user conversations and messages
-                cursor.execute("SELECT conversation_id FROM conversations WHERE user_id = ?", (user_id,))
-                conversation_ids = [row[0] for row in cursor.fetchall()]
-                
-                for conv_id in conversation_ids:
-                    cursor.execute("DELETE FROM messages WHERE conversation_id = ?", (conv_id,))
-                
-                cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
-                cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            # Delete messages, conversations and users in one statement each
+            cursor.execute("""
+                DELETE FROM messages WHERE conversation_id IN (
+                    SELECT conversation_id FROM conversations WHERE user_id IN (
+                        SELECT user_id FROM users WHERE last_active < datetime('now', ?)
+                          AND user_id NOT LIKE 'auth\\_user\\_%' ESCAPE '\\'
+                    )
+                )
+            """, (cutoff,))
+            cursor.execute("""
+                DELETE FROM conversations WHERE user_id IN (
+                    SELECT user_id FROM users WHERE last_active < datetime('now', ?)
+                      AND user_id NOT LIKE 'auth\\_user\\_%' ESCAPE '\\'
+                )
+            """, (cutoff,))
+            cursor.execute("""
+                DELETE FROM users WHERE last_active < datetime('now', ?)
+                  AND user_id NOT LIKE 'auth\\_user\\_%' ESCAPE '\\'
+            """, (cutoff,))
             
             conn.commit()
-            print(f"✅ Cleaned up {len(inactive_users)} inactive users")
+            print(f"✅ Cleaned up {inactive_count} inactive users")
             return True
             
     except Exception as e:
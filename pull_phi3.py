@@ -3,64 +3,93 @@
 Script to pull the Phi-3 model in the Ollama container
 """
 
+import json
+import random
 import requests
 import time
 import os
 import sys
 
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+SESSION = requests.Session()  # Reuse one keep-alive connection for all calls
+RETRY_DELAY = 0.5  # Base delay in seconds, doubled after each failed attempt
+MAX_RETRY_DELAY = 30
 MODEL_NAME = "phi3:latest"
 
 def wait_for_ollama():
-    """Wait for Ollama to be ready"""
+    """Wait for Ollama to be ready and return the set of installed model names"""
     print("⏳ Waiting for Ollama to be ready...")
-    max_attempts = 30
+    max_attempts = 10
     attempt = 0
     
     while attempt < max_attempts:
         try:
-            response = requests.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=5)
+            response = SESSION.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=5)
             if response.status_code == 200:
                 print("✅ Ollama is ready!")
-                return True
-        except requests.exceptions.RequestException:
+                data = response.json()
+                return {model['name'] for model in data.get('models', [])}
+        except (requests.exceptions.RequestException, ValueError):
             pass
         
+        # Exponential backoff with jitter so restarting sidecars don't poll in lockstep
+        delay = min(RETRY_DELAY * (2 ** attempt) + random.uniform(0, 0.5), MAX_RETRY_DELAY)
         attempt += 1
-        print(f"   Attempt {attempt}/{max_attempts}...")
-        time.sleep(2)
+        print(f"   Attempt {attempt}/{max_attempts}, retrying in {delay:.1f}s...")
+        time.sleep(delay)
     
     print("❌ Ollama failed to start within expected time")
-    return False
+    return None
 
-def check_model_exists():
-    """Check if Phi-3 model already exists"""
-    try:
-        response = requests.get(f"{OLLAMA_BASE_URL}/api/tags")
-        if response.status_code == 200:
-            data = response.json()
-            models = [model['name'] for model in data.get('models', [])]
-            return MODEL_NAME in models
-    except:
-        pass
-    return False
+def check_model_exists(models):
+    """Check if Phi-3 model is among the installed models"""
+    return MODEL_NAME in models
 
 def pull_model():
     """Pull the Phi-3 model"""
     print(f"📦 Pulling {MODEL_NAME} model...")
     
     try:
-        response = requests.post(
+        response = SESSION.post(
             f"{OLLAMA_BASE_URL}/api/pull",
             json={"name": MODEL_NAME},
-            timeout=300  # 5 minutes timeout
+            timeout=300,  # 5 minutes timeout
+            stream=True
         )
         
-        if response.status_code == 200:
+        if response.status_code != 200:
+            print(f"❌ Failed to pull model: {response.status_code}")
+            return False
+        
+        # Ollama streams one JSON progress event per line while pulling
+        status = None
+        for line in response.iter_lines(decode_unicode=True):
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            
+            if 'error' in event:
+                print(f"\n❌ Failed to pull model: {event['error']}")
+                return False
+            
+            status = event.get('status', '')
+            completed = event.get('completed', 0)
+            total = event.get('total', 0)
+            if total:
+                progress = f"{status}: {completed * 100 // total}% ({completed // 1048576}/{total // 1048576} MB)"
+            else:
+                progress = status
+            print(f"\r   {progress[:70]:<70}", end='', flush=True)
+        print()
+        
+        if status == 'success':
             print(f"✅ Successfully pulled {MODEL_NAME} model!")
             return True
         else:
-            print(f"❌ Failed to pull model: {response.status_code}")
+            print("❌ Model pull ended before completing")
             return False
             
     except requests.exceptions.Timeout:
@@ -75,12 +104,13 @@ def main():
     print("🤖 Phi-3 Model Setup Script")
     print("=" * 40)
     
-    # Wait for Ollama to be ready
-    if not wait_for_ollama():
+    # Wait for Ollama to be ready (the same response lists installed models)
+    models = wait_for_ollama()
+    if models is None:
         sys.exit(1)
     
     # Check if model already exists
-    if check_model_exists():
+    if check_model_exists(models):
         print(f"✅ {MODEL_NAME} model already exists!")
         return
     
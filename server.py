@@ -5,16 +5,26 @@ A simple Flask server that connects to Ollama API for AI chat functionality.
 """
 
 import os
+import sys
 import json
+import orjson
 import requests
+from urllib3.util.retry import Retry
 import time
 import re
 import sqlite3
+import queue
+import atexit
 import secrets
-import string
+import ipaddress
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from flask import Flask, request, jsonify, send_from_directory, render_template_string, redirect, url_for, session, flash
+from flask import Flask, Response, request, jsonify, send_from_directory, render_template, redirect, url_for, session, flash, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from auth import auth_manager, login_required, get_current_user
 import logging
 
@@ -22,42 +32,160 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class ORJSONProvider(DefaultJSONProvider):
+    """Encode and decode Flask JSON (jsonify, request.get_json) with orjson"""
+    
+    # Calls with extra arguments (e.g. the session serializer's object_hook) keep
+    # the standard json behaviour; plain calls go through orjson
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default).decode()
+    
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Pass orjson's bytes straight to the response instead of round-tripping through str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default), mimetype=self.mimetype)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 
 # Generate a secure secret key if not provided
 def generate_secret_key():
     """Generate a secure random secret key"""
-    alphabet = string.ascii_letters + string.digits + string.punctuation
-    return ''.join(secrets.choice(alphabet) for _ in range(32))
+    return secrets.token_urlsafe(32)
 
-app.secret_key = os.getenv('SECRET_KEY', generate_secret_key())
+app.secret_key = os.getenv('SECRET_KEY') or generate_secret_key()
 CORS(app)  # Enable CORS for all routes
 
+# Number of reverse proxies in front of the app. Only trust X-Forwarded-For/Proto
+# when set, otherwise clients could pick their own rate limit key
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", "0"))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+
 # Security configuration
 MAX_MESSAGE_LENGTH = 1000
-ALLOWED_MODELS = ['phi3:latest', 'deepseek-r1:1.5b', 'llama3:latest']
+ALLOWED_MODELS = frozenset(['phi3:latest', 'deepseek-r1:1.5b', 'llama3:latest'])
+
+# Validation patterns, compiled once at import. None of them backtrack over a
+# lazy .*? scan, so every check is linear in the input length
+_DANGEROUS_RE = re.compile(
+    r'(?:<script\b|javascript:|data:text/html|\bon\w+\s*=)',
+    re.IGNORECASE
+)
+_CONV_ID_RE = re.compile(r'[a-zA-Z0-9_-]+')
+_EMAIL_RE = re.compile(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}')
+
+# Single-pass translation tables for input cleanup and HTML escaping
+_NULL_TABLE = str.maketrans({'\x00': None})
+_HTML_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
 
 # Rate limiting
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
 import threading
 request_counts = defaultdict(int)
-request_times = defaultdict(list)
-rate_limit_lock = threading.Lock()
+
+# Request times are split across lock stripes by IP so unrelated clients don't contend
+RATE_LIMIT_STRIPES = 32
+rate_limit_locks = [threading.Lock() for _ in range(RATE_LIMIT_STRIPES)]
+request_times = [defaultdict(deque) for _ in range(RATE_LIMIT_STRIPES)]
+# Each stripe forgets idle IPs about once per window
+rate_limit_next_sweep = [0.0] * RATE_LIMIT_STRIPES
+
+# With REDIS_URL set, limits are kept in Redis so they are shared by all workers.
+# The sorted-set window is trimmed, counted and appended atomically in one script
+REDIS_URL = os.getenv("REDIS_URL")
+_RATE_LIMIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, now - window)
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[1], now, ARGV[4])
+    redis.call('PEXPIRE', KEYS[1], window)
+    return 0
+end
+-- Blocked: return the milliseconds until the oldest request leaves the window
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+return math.max(tonumber(oldest[2]) + window - now, 1)
+"""
+
+# IPs known to be over the limit, mapped to when they may retry. Repeated
+# requests from a blocked IP are rejected without a Redis round trip
+RATE_LIMIT_BLOCK_CACHE_SIZE = 100000
+blocked_until = OrderedDict()
+blocked_until_lock = threading.Lock()
+
+redis_rate_limit = None
+if REDIS_URL:
+    import redis
+    # register_script calls EVALSHA and loads the script on first use
+    redis_rate_limit = redis.Redis.from_url(REDIS_URL).register_script(_RATE_LIMIT_SCRIPT)
+
+@lru_cache(maxsize=65536)
+def canon_ip(ip):
+    """Normalize an IP address so different spellings share one rate limit key"""
+    try:
+        return str(ipaddress.ip_address(ip))
+    except ValueError:
+        return ip
 
 def check_rate_limit(ip, max_requests=10, window_seconds=60):
     """Simple rate limiting"""
-    with rate_limit_lock:
+    if redis_rate_limit is not None:
         current_time = time.time()
+        with blocked_until_lock:
+            retry_at = blocked_until.get(ip)
+            if retry_at is not None:
+                if retry_at > current_time:
+                    return False
+                del blocked_until[ip]
         
-        # Clean old requests
-        request_times[ip] = [t for t in request_times[ip] if current_time - t < window_seconds]
+        now_ms = int(current_time * 1000)
+        try:
+            retry_after_ms = redis_rate_limit(keys=[f'rl:{ip}'],
+                                              args=[now_ms, window_seconds * 1000, max_requests,
+                                                    f'{now_ms}:{secrets.token_hex(4)}'])
+            if not retry_after_ms:
+                return True
+            with blocked_until_lock:
+                blocked_until[ip] = current_time + retry_after_ms / 1000
+                if len(blocked_until) > RATE_LIMIT_BLOCK_CACHE_SIZE:
+                    blocked_until.popitem(last=False)
+            return False
+        except redis.RedisError as e:
+            # Fall back to the per-process limiter while Redis is unavailable
+            logger.error(f"Redis rate limit check failed: {e}")
+    
+    stripe = hash(ip) & (RATE_LIMIT_STRIPES - 1)
+    with rate_limit_locks[stripe]:
+        current_time = time.monotonic()
+        cutoff = current_time - window_seconds
+        
+        # Remove IPs with no requests left in the window so the map doesn't grow forever
+        if current_time >= rate_limit_next_sweep[stripe]:
+            stripe_times = request_times[stripe]
+            for idle_ip in [k for k, t in stripe_times.items() if not t or t[-1] <= cutoff]:
+                del stripe_times[idle_ip]
+            rate_limit_next_sweep[stripe] = current_time + window_seconds
+        
+        times = request_times[stripe][ip]
+        
+        # Drop expired requests from the oldest end
+        while times and times[0] <= cutoff:
+            times.popleft()
         
         # Check if limit exceeded
-        if len(request_times[ip]) >= max_requests:
+        if len(times) >= max_requests:
             return False
         
         # Add current request
-        request_times[ip].append(current_time)
+        times.append(current_time)
         return True
 
 def add_security_headers(response):
@@ -77,7 +205,30 @@ def after_request(response):
 # Configuration
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
 DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "phi3:latest")
+OLLAMA_CACHE_TTL = int(os.getenv("OLLAMA_CACHE_TTL", "30"))
+# Failed checks are remembered briefly so health pollers don't each wait on a down Ollama
+OLLAMA_FAILURE_TTL = 2
+# (connect, read) timeouts: fail fast when Ollama is down, but give generation time
+OLLAMA_CONNECT_TIMEOUT = 1
+OLLAMA_TAGS_TIMEOUT = (OLLAMA_CONNECT_TIMEOUT, 5)
+OLLAMA_GENERATE_TIMEOUT = (OLLAMA_CONNECT_TIMEOUT, 60)
 DATABASE_PATH = os.getenv("DATABASE_PATH", "chatbot.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+# Messages returned per conversation by /api/conversations?include_last=1
+CONVERSATION_PREVIEW_MESSAGES = 20
+# Most messages committed together by the background writer
+MESSAGE_BATCH_SIZE = 64
+# How often the writer refreshes planner statistics with PRAGMA optimize
+DB_OPTIMIZE_INTERVAL = 3600
+# Match the number of requests Ollama generates at once so its batch stays full
+GEN_WORKERS = int(os.getenv("GEN_WORKERS", os.getenv("OLLAMA_NUM_PARALLEL", "4")))
+GEN_JOB_TTL = 600
+# Streamed tokens are sent in batches of this many tokens, or after this many seconds
+STREAM_FLUSH_TOKENS = 16
+STREAM_FLUSH_INTERVAL = 0.05
+
+# General conversational prompt used for every chat
+SYSTEM_PROMPT = """You are a friendly and helpful AI assistant. Respond naturally to any question or topic. Be conversational, helpful, and engaging. You can discuss anything from casual conversation to technical topics."""
 
 def validate_input(data, max_length=MAX_MESSAGE_LENGTH):
     """Validate and sanitize user input"""
@@ -85,23 +236,15 @@ def validate_input(data, max_length=MAX_MESSAGE_LENGTH):
         return None
     
     # Remove any null bytes and excessive whitespace
-    data = data.strip().replace('\x00', '')
+    data = data.translate(_NULL_TABLE).strip()
     
     # Check length
     if len(data) > max_length:
         return None
     
     # Basic content validation (prevent script injection)
-    dangerous_patterns = [
-        r'<script[^>]*>.*?</script>',
-        r'javascript:',
-        r'data:text/html',
-        r'on\w+\s*=',
-    ]
-    
-    for pattern in dangerous_patterns:
-        if re.search(pattern, data, re.IGNORECASE):
-            return None
+    if _DANGEROUS_RE.search(data):
+        return None
     
     return data
 
@@ -109,27 +252,110 @@ def validate_model(model):
     """Validate model name"""
     return model in ALLOWED_MODELS
 
+def new_conversation_id():
+    """Generate a random conversation ID"""
+    return 'chat_' + secrets.token_hex(8)
+
 def validate_conversation_id(conversation_id):
     """Validate conversation ID format"""
     if not conversation_id or not isinstance(conversation_id, str):
         return False
     
     # Only allow alphanumeric, underscore, and hyphen
-    return bool(re.match(r'^[a-zA-Z0-9_-]+$', conversation_id))
+    return bool(_CONV_ID_RE.fullmatch(conversation_id))
 
 class DatabaseManager:
     """Manages SQLite database operations for chat history"""
     
-    def __init__(self, db_path=DATABASE_PATH):
+    def __init__(self, db_path=DATABASE_PATH, pool_size=DB_POOL_SIZE):
         self.db_path = db_path
+        # LIFO hands out the most recently used connection, whose page cache is warmest,
+        # and lets the rest go idle
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._stats_lock = threading.Lock()
+        self.pool_stats = {'checkouts': 0, 'opened': 0, 'checkout_seconds': 0.0}
         self.init_database()
+        
+        # Messages are written by one background thread so concurrent requests share commits
+        self._message_queue = queue.Queue()
+        self._next_optimize = time.monotonic() + DB_OPTIMIZE_INTERVAL
+        self._message_writer = threading.Thread(target=self._write_messages, name='message-writer', daemon=True)
+        self._message_writer.start()
+    
+    def _connect(self):
+        """Open a connection with the per-connection performance settings applied"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-65536')
+        # Bound the rows ANALYZE samples per index so PRAGMA optimize stays cheap
+        conn.execute('PRAGMA analysis_limit=400')
+        if self.db_path != ':memory:':
+            conn.execute('PRAGMA mmap_size=268435456')
+            # Checkpoint the WAL in small steps and truncate it back to 64MB afterwards
+            conn.execute('PRAGMA wal_autocheckpoint=1000')
+            conn.execute('PRAGMA journal_size_limit=67108864')
+        return conn
+    
+    @contextmanager
+    def _conn(self):
+        """Check out a pooled connection, committing or rolling back on exit"""
+        start = time.perf_counter()
+        opened = False
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            # Pool is empty, open another connection
+            conn = self._connect()
+            opened = True
+        
+        with self._stats_lock:
+            self.pool_stats['checkouts'] += 1
+            self.pool_stats['opened'] += opened
+            self.pool_stats['checkout_seconds'] += time.perf_counter() - start
+        
+        try:
+            with conn:
+                yield conn
+        finally:
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+    
+    def close(self):
+        """Flush queued messages, checkpoint the WAL and close all pooled connections"""
+        if self._message_writer.is_alive():
+            self._message_queue.put(None)
+            self._message_writer.join()
+        
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                # Recommended before closing: analyzes tables whose statistics are missing or stale
+                conn.execute('PRAGMA optimize')
+                if self.db_path != ':memory:':
+                    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            except sqlite3.Error as e:
+                logger.error(f"Error checkpointing database: {e}")
+            finally:
+                conn.close()
     
     def init_database(self):
         """Initialize the database with required tables"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._conn() as conn:
                 cursor = conn.cursor()
                 
+                # WAL lets readers run alongside a writer and is stored in the
+                # database file, so every later connection picks it up
+                if self.db_path != ':memory:':
+                    cursor.execute('PRAGMA journal_mode=WAL')
+                
                 # Create users table
                 cursor.execute('''
                     CREATE TABLE IF NOT EXISTS users (
@@ -168,6 +394,30 @@ class DatabaseManager:
                     )
                 ''')
                 
+                # Index for activity-based stats and cleanup in db_utils
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_users_last_active
+                    ON users(last_active)
+                ''')
+                
+                # Indexes matching the (filter, sort) order of the history queries. The
+                # messages index is ascending so a backward scan yields timestamp DESC,
+                # id DESC (id is the rowid tiebreak) without a temp B-tree; the old
+                # DESC index is dropped from existing databases
+                cursor.execute('DROP INDEX IF EXISTS idx_messages_conv_ts')
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_messages_conv_time
+                    ON messages(conversation_id, timestamp)
+                ''')
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_conv_user_updated
+                    ON conversations(user_id, updated_at DESC)
+                ''')
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_conv_conv_id
+                    ON conversations(conversation_id, user_id)
+                ''')
+                
                 conn.commit()
                 logger.info("Database initialized successfully")
                 
@@ -177,26 +427,18 @@ class DatabaseManager:
     def get_or_create_user(self, user_id, username=None):
         """Get existing user or create new one"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._conn() as conn:
                 cursor = conn.cursor()
                 
-                # Check if user exists
-                cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-                user = cursor.fetchone()
-                
-                if user:
-                    # Update last_active
-                    cursor.execute('UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE user_id = ?', (user_id,))
-                    conn.commit()
-                    return user[1]  # Return user_id
-                else:
-                    # Create new user
-                    cursor.execute('''
-                        INSERT INTO users (user_id, username) 
-                        VALUES (?, ?)
-                    ''', (user_id, username or f"User_{user_id[:8]}"))
-                    conn.commit()
-                    return user_id
+                # Create the user, or refresh username and last_active if it already exists
+                cursor.execute('''
+                    INSERT INTO users (user_id, username) 
+                    VALUES (?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET username = excluded.username,
+                                                       last_active = CURRENT_TIMESTAMP
+                ''', (user_id, username or f"User_{user_id[:8]}"))
+                conn.commit()
+                return user_id
                     
         except Exception as e:
             logger.error(f"Error in get_or_create_user: {e}")
@@ -205,7 +447,7 @@ class DatabaseManager:
     def create_conversation(self, user_id, conversation_id, model=DEFAULT_MODEL):
         """Create a new conversation"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._conn() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     INSERT INTO conversations (user_id, conversation_id, model)
@@ -219,59 +461,144 @@ class DatabaseManager:
     
     def add_message(self, conversation_id, role, content, model=None):
         """Add a message to the database"""
+        return self.add_messages(conversation_id, [(role, content, model)])
+    
+    def add_messages(self, conversation_id, rows):
+        """Add several (role, content, model) messages in a single transaction"""
+        # Wait for the writer so the messages are visible to the next read
+        item = {'conversation_id': conversation_id, 'rows': rows,
+                'done': threading.Event(), 'ok': False}
+        self._message_queue.put(item)
+        item['done'].wait()
+        return item['ok']
+    
+    def _write_messages(self):
+        """Commit queued messages, grouping everything queued meanwhile into one transaction"""
+        while True:
+            item = self._message_queue.get()
+            if item is None:
+                return
+            
+            batch = [item]
+            stop = False
+            while len(batch) < MESSAGE_BATCH_SIZE:
+                try:
+                    item = self._message_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            
+            self._commit_messages(batch)
+            if stop:
+                return
+            
+            if time.monotonic() >= self._next_optimize:
+                self.optimize()
+                self._next_optimize = time.monotonic() + DB_OPTIMIZE_INTERVAL
+    
+    def optimize(self):
+        """Refresh planner statistics for tables that need it"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT INTO messages (conversation_id, role, content, model)
-                    VALUES (?, ?, ?, ?)
-                ''', (conversation_id, role, content, model))
-                
-                # Update conversation timestamp
-                cursor.execute('''
-                    UPDATE conversations 
-                    SET updated_at = CURRENT_TIMESTAMP 
-                    WHERE conversation_id = ?
-                ''', (conversation_id,))
-                
-                conn.commit()
-                return True
+            with self._conn() as conn:
+                conn.execute('PRAGMA optimize')
+        except sqlite3.Error as e:
+            logger.error(f"Error optimizing database: {e}")
+    
+    def _commit_messages(self, batch):
+        """Insert a batch of queued messages and wake up the waiting requests"""
+        try:
+            self._insert_messages(batch)
+            for item in batch:
+                item['ok'] = True
         except Exception as e:
             logger.error(f"Error adding message: {e}")
-            return False
+            if len(batch) > 1:
+                # Retry one by one so a single bad item doesn't fail the whole batch
+                for item in batch:
+                    try:
+                        self._insert_messages([item])
+                        item['ok'] = True
+                    except Exception as e:
+                        logger.error(f"Error adding message: {e}")
+        
+        for item in batch:
+            item['done'].set()
+    
+    def _insert_messages(self, batch):
+        """Insert the rows of the given items and touch their conversations in one transaction"""
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.executemany('''
+                INSERT INTO messages (conversation_id, role, content, model)
+                VALUES (?, ?, ?, ?)
+            ''', [(item['conversation_id'], role, content, model)
+                  for item in batch for role, content, model in item['rows']])
+            
+            # Update conversation timestamps
+            cursor.executemany('''
+                UPDATE conversations 
+                SET updated_at = CURRENT_TIMESTAMP 
+                WHERE conversation_id = ?
+            ''', [(conversation_id,) for conversation_id in {item['conversation_id'] for item in batch}])
+            
+            conn.commit()
+    
+    def _fetch_messages(self, cursor, conversation_id, limit):
+        """Fetch the latest messages of a conversation in chronological order"""
+        # Optimized query with DESC order and LIMIT for faster retrieval
+        cursor.execute('''
+            SELECT role, content, model, timestamp
+            FROM messages 
+            WHERE conversation_id = ?
+            ORDER BY timestamp DESC, id DESC
+            LIMIT ?
+        ''', (conversation_id, limit))
+        
+        # Prepend while iterating to get chronological order in a single pass
+        messages = deque()
+        for row in cursor:
+            messages.appendleft({
+                'role': row[0],
+                'content': row[1],
+                'model': row[2],
+                'timestamp': row[3]
+            })
+        return list(messages)
     
     def get_conversation_messages(self, conversation_id, limit=50):
         """Get messages for a conversation (optimized for speed)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._conn() as conn:
+                return self._fetch_messages(conn.cursor(), conversation_id, limit)
+        except Exception as e:
+            logger.error(f"Error getting conversation messages: {e}")
+            return []
+    
+    def get_recent_context(self, conversation_id, limit=2):
+        """Get the latest (role, content) pairs of a conversation in chronological order"""
+        try:
+            with self._conn() as conn:
                 cursor = conn.cursor()
-                # Optimized query with DESC order and LIMIT for faster retrieval
                 cursor.execute('''
-                    SELECT role, content, model, timestamp
+                    SELECT role, content
                     FROM messages 
                     WHERE conversation_id = ?
-                    ORDER BY timestamp DESC
+                    ORDER BY timestamp DESC, id DESC
                     LIMIT ?
                 ''', (conversation_id, limit))
-                
-                messages = []
-                for row in cursor.fetchall():
-                    messages.append({
-                        'role': row[0],
-                        'content': row[1],
-                        'model': row[2],
-                        'timestamp': row[3]
-                    })
-                # Reverse to get correct chronological order
-                return list(reversed(messages))
+                return cursor.fetchall()[::-1]
         except Exception as e:
-            logger.error(f"Error getting conversation messages: {e}")
+            logger.error(f"Error getting recent context: {e}")
             return []
     
     def get_user_conversations(self, user_id):
         """Get all conversations for a user"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._conn() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT conversation_id, title, model, created_at, updated_at
@@ -294,11 +621,102 @@ class DatabaseManager:
             logger.error(f"Error getting user conversations: {e}")
             return []
     
+    def get_user_conversations_with_messages(self, user_id, limit=20):
+        """Get all conversations for a user with their latest messages, in one query"""
+        try:
+            with self._conn() as conn:
+                cursor = conn.cursor()
+                # SQLite has no LATERAL join; the correlated subquery reads each
+                # conversation's latest `limit` ids from the messages index and the
+                # join then fetches just those rows by rowid
+                cursor.execute('''
+                    SELECT c.conversation_id, c.title, c.model, c.created_at, c.updated_at,
+                           m.role, m.content, m.model, m.timestamp
+                    FROM conversations c
+                    LEFT JOIN messages m ON m.id IN (
+                        SELECT id FROM messages
+                        WHERE conversation_id = c.conversation_id
+                        ORDER BY timestamp DESC, id DESC
+                        LIMIT ?
+                    )
+                    WHERE c.user_id = ?
+                    ORDER BY c.updated_at DESC, c.conversation_id, m.timestamp ASC, m.id ASC
+                ''', (limit, user_id))
+                
+                conversations = []
+                current = None
+                for row in cursor:
+                    if current is None or row[0] != current['conversation_id']:
+                        current = {
+                            'conversation_id': row[0],
+                            'title': row[1],
+                            'model': row[2],
+                            'created_at': row[3],
+                            'updated_at': row[4],
+                            'messages': []
+                        }
+                        conversations.append(current)
+                    
+                    # Conversations without messages come back with NULL message columns
+                    if row[5] is not None:
+                        current['messages'].append({
+                            'role': row[5],
+                            'content': row[6],
+                            'model': row[7],
+                            'timestamp': row[8]
+                        })
+                return conversations
+        except Exception as e:
+            logger.error(f"Error getting user conversations with messages: {e}")
+            return []
+    
+    def load_index_context(self, user_id, conversation_id, limit=50):
+        """Load what the index page needs using a single pooled connection
+        
+        Returns a dict with the resolved conversation_id and its messages, or
+        None if the requested conversation does not belong to the user.
+        For the 'default' conversation the user's most recent one is used.
+        """
+        try:
+            with self._conn() as conn:
+                cursor = conn.cursor()
+                
+                if conversation_id != 'default':
+                    cursor.execute('''
+                        SELECT EXISTS(
+                            SELECT 1 FROM conversations
+                            WHERE conversation_id = ? AND user_id = ?
+                        )
+                    ''', (conversation_id, user_id))
+                    if not cursor.fetchone()[0]:
+                        return None
+                else:
+                    cursor.execute('''
+                        SELECT conversation_id FROM conversations
+                        WHERE user_id = ?
+                        ORDER BY updated_at DESC
+                        LIMIT 1
+                    ''', (user_id,))
+                    row = cursor.fetchone()
+                    if not row:
+                        return {'conversation_id': conversation_id, 'messages': []}
+                    conversation_id = row[0]
+                
+                return {
+                    'conversation_id': conversation_id,
+                    'messages': self._fetch_messages(cursor, conversation_id, limit)
+                }
+        except Exception as e:
+            logger.error(f"Error loading index context: {e}")
+            return {'conversation_id': conversation_id, 'messages': []}
+    
     def delete_conversation(self, conversation_id):
         """Delete a conversation and all its messages"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._conn() as conn:
                 cursor = conn.cursor()
+                # Take the write lock up front so both deletes commit as one transaction
+                cursor.execute('BEGIN IMMEDIATE')
                 # Delete messages first (foreign key constraint)
                 cursor.execute('DELETE FROM messages WHERE conversation_id = ?', (conversation_id,))
                 # Delete conversation
@@ -312,15 +730,14 @@ class DatabaseManager:
     def clear_user_conversations(self, user_id):
         """Clear all conversations for a user"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._conn() as conn:
                 cursor = conn.cursor()
-                # Get all conversation IDs for the user
-                cursor.execute('SELECT conversation_id FROM conversations WHERE user_id = ?', (user_id,))
-                conversation_ids = [row[0] for row in cursor.fetchall()]
-                
-                # Delete messages for all conversations
-                for conv_id in conversation_ids:
-                    cursor.execute('DELETE FROM messages WHERE conversation_id = ?', (conv_id,))
+                # Delete messages for all of the user's conversations in one statement
+                cursor.execute('''
+                    DELETE FROM messages WHERE conversation_id IN (
+                        SELECT conversation_id FROM conversations WHERE user_id = ?
+                    )
+                ''', (user_id,))
                 
                 # Delete conversations
                 cursor.execute('DELETE FROM conversations WHERE user_id = ?', (user_id,))
@@ -333,20 +750,23 @@ class DatabaseManager:
     def conversation_belongs_to_user(self, conversation_id, user_id):
         """Check if a conversation belongs to a specific user"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._conn() as conn:
                 cursor = conn.cursor()
+                # EXISTS stops at the first matching row
                 cursor.execute('''
-                    SELECT COUNT(*) FROM conversations 
-                    WHERE conversation_id = ? AND user_id = ?
+                    SELECT EXISTS(
+                        SELECT 1 FROM conversations
+                        WHERE conversation_id = ? AND user_id = ?
+                    )
                 ''', (conversation_id, user_id))
-                count = cursor.fetchone()[0]
-                return count > 0
+                return bool(cursor.fetchone()[0])
         except Exception as e:
             logger.error(f"Error checking conversation ownership: {e}")
             return False
 
 # Initialize database manager
 db_manager = DatabaseManager()
+atexit.register(db_manager.close)
 
 class OllamaClient:
     """Client for communicating with Ollama API"""
@@ -354,27 +774,54 @@ class OllamaClient:
     def __init__(self, base_url=OLLAMA_BASE_URL):
         self.base_url = base_url
         self.session = requests.Session()
+        
+        # Larger keep-alive pool so concurrent requests reuse connections. Only
+        # failed connects are retried; read timeouts and error statuses are not,
+        # so a hung Ollama fails after one timeout instead of several
+        retries = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.1)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Connection': 'keep-alive', 'User-Agent': 'ai-chatbot/1.0'})
+        
+        # Successful /api/tags results are reused for OLLAMA_CACHE_TTL seconds,
+        # failures for OLLAMA_FAILURE_TTL seconds
+        self._models = None
+        self._models_expiry = 0.0
+        self._models_lock = threading.Lock()
+    
+    def _get_models(self):
+        """Get the installed model names, or None if Ollama is unreachable"""
+        if time.monotonic() < self._models_expiry:
+            return self._models
+        
+        # Only one thread refreshes; the others wait and reuse its result
+        with self._models_lock:
+            if time.monotonic() < self._models_expiry:
+                return self._models
+            try:
+                response = self.session.get(f"{self.base_url}/api/tags", timeout=OLLAMA_TAGS_TIMEOUT)
+                if response.status_code == 200:
+                    data = response.json()
+                    self._models = [model['name'] for model in data.get('models', [])]
+                    self._models_expiry = time.monotonic() + OLLAMA_CACHE_TTL
+                    return self._models
+                logger.error(f"Ollama API error: {response.status_code}")
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logger.error(f"Failed to connect to Ollama: {e}")
+            
+            self._models = None
+            self._models_expiry = time.monotonic() + OLLAMA_FAILURE_TTL
+            return None
     
     def check_connection(self):
         """Check if Ollama server is running"""
-        try:
-            response = self.session.get(f"{self.base_url}/api/tags", timeout=5)
-            return response.status_code == 200
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to connect to Ollama: {e}")
-            return False
+        return self._get_models() is not None
     
     def get_available_models(self):
         """Get list of available models"""
-        try:
-            response = self.session.get(f"{self.base_url}/api/tags")
-            if response.status_code == 200:
-                data = response.json()
-                return [model['name'] for model in data.get('models', [])]
-            return []
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to get models: {e}")
-            return []
+        models = self._get_models()
+        return list(models) if models is not None else []
     
     def generate_response(self, message, model=DEFAULT_MODEL, system_prompt=None):
         """Generate response using Ollama API with streaming for faster responses"""
@@ -398,7 +845,7 @@ class OllamaClient:
             response = self.session.post(
                 f"{self.base_url}/api/generate",
                 json=payload,
-                timeout=60,  # Reduced timeout
+                timeout=OLLAMA_GENERATE_TIMEOUT,
                 stream=True  # Enable streaming
             )
             
@@ -408,7 +855,7 @@ class OllamaClient:
                 for line in response.iter_lines():
                     if line:
                         try:
-                            data = json.loads(line.decode('utf-8'))
+                            data = json.loads(line)
                             if 'response' in data:
                                 full_response += data['response']
                             if data.get('done', False):
@@ -450,7 +897,7 @@ class OllamaClient:
             response = self.session.post(
                 f"{self.base_url}/api/generate",
                 json=payload,
-                timeout=60,
+                timeout=OLLAMA_GENERATE_TIMEOUT,
                 stream=True
             )
             
@@ -458,7 +905,7 @@ class OllamaClient:
                 for line in response.iter_lines():
                     if line:
                         try:
-                            data = json.loads(line.decode('utf-8'))
+                            data = json.loads(line)
                             if 'response' in data:
                                 yield data['response']
                             if data.get('done', False):
@@ -479,65 +926,28 @@ class OllamaClient:
 # Initialize Ollama client
 ollama_client = OllamaClient()
 
+# Fenced code blocks (```language code ```) or inline code (`code`) in AI responses
+_CODE_RE = re.compile(r'```(\w+)?\n(.*?)```|`([^`]+)`', re.DOTALL)
+
 def format_code_blocks(text):
     """Format code blocks in the text with proper HTML structure"""
-    # Pattern to match code blocks: ```language code ```
-    pattern = r'```(\w+)?\n(.*?)```'
-    
-    def replace_code_block(match):
+    def replace_code(match):
+        # Inline code
+        if match.group(2) is None:
+            code = match.group(3).translate(_HTML_TABLE)
+            return f'<code>{code}</code>'
+        
         language = match.group(1) or 'text'
-        code = match.group(2).strip()
         
         # Escape HTML characters in the code
-        code = code.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        code = match.group(2).strip().translate(_HTML_TABLE)
         
         # Format as HTML code block without inline syntax highlighting
-        escaped_code = code.replace("`", "\\`")
+        escaped_code = code.replace("`", "\\`").replace('"', '&quot;')
         return f'<div class="code-block"><div class="code-header"><span class="language">{language}</span><button class="copy-btn" onclick="navigator.clipboard.writeText(`{escaped_code}`)">Copy</button></div><pre><code class="language-{language.lower()}">{code}</code></pre></div>'
     
-    # Replace code blocks
-    formatted_text = re.sub(pattern, replace_code_block, text, flags=re.DOTALL)
-    
-    # Also format inline code
-    inline_pattern = r'`([^`]+)`'
-    def replace_inline_code(match):
-        code = match.group(1)
-        code = code.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-        return f'<code>{code}</code>'
-    
-    formatted_text = re.sub(inline_pattern, replace_inline_code, formatted_text)
-    
-    # Handle cases where AI might not format code properly
-    # Look for code-like patterns that weren't caught by the above patterns
-    if '```' in text and '```' not in formatted_text:
-        # If there are backticks but they weren't processed, try to fix them
-        lines = text.split('\n')
-        in_code_block = False
-        code_lines = []
-        language = 'text'
-        
-        for line in lines:
-            if line.strip().startswith('```'):
-                if not in_code_block:
-                    # Start of code block
-                    in_code_block = True
-                    lang_match = re.match(r'```(\w+)', line.strip())
-                    if lang_match:
-                        language = lang_match.group(1)
-                    code_lines = []
-                else:
-                    # End of code block
-                    in_code_block = False
-                    if code_lines:
-                        code = '\n'.join(code_lines)
-                        code = code.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-                        escaped_code = code.replace("`", "\\`")
-                        code_block_html = f'<div class="code-block"><div class="code-header"><span class="language">{language}</span><button class="copy-btn" onclick="navigator.clipboard.writeText(`{escaped_code}`)">Copy</button></div><pre><code class="language-{language.lower()}">{code}</code></pre></div>'
-                        formatted_text = formatted_text.replace(f'```{language}\n{code}\n```', code_block_html)
-            elif in_code_block:
-                code_lines.append(line)
-    
-    return formatted_text
+    # A single pass handles both forms, so generated HTML is never re-scanned
+    return _CODE_RE.sub(replace_code, text)
 
 def get_user_id():
     """Get authenticated user ID or create anonymous user ID"""
@@ -561,10 +971,63 @@ def get_user_id():
     user_id = f"anon_user_{int(time.time())}_{os.getpid()}"
     # Don't store in session for anonymous users
     # session['user_id'] = user_id  # Comment this out
-    # Create user in database
-    db_manager.get_or_create_user(user_id)
+    # The ID changes on every request, so it is not stored in the database.
+    # cleanup_old_data removes anonymous conversations by their own updated_at
     return user_id
 
+def build_chat_prompt(conversation_id, user_message):
+    """Build the prompt for a chat turn from recent conversation context"""
+    # Get recent conversation context (last 2 messages for faster processing)
+    recent_messages = db_manager.get_recent_context(conversation_id, 2)
+    context = "\n".join(f"{role}: {content}" for role, content in recent_messages)
+    
+    # Include minimal conversation context in the prompt
+    return f"{context}\n\nUser: {user_message}\nAssistant:"
+
+# AI responses are generated on a separate pool so request threads return immediately
+_gen_pool = ThreadPoolExecutor(max_workers=GEN_WORKERS, thread_name_prefix='generate')
+generation_jobs = {}
+generation_jobs_lock = threading.Lock()
+
+def generate_and_save_response(conversation_id, user_message, model):
+    """Generate an AI response and add it to the conversation"""
+    try:
+        full_prompt = build_chat_prompt(conversation_id, user_message)
+        response = ollama_client.generate_response(full_prompt, model, SYSTEM_PROMPT)
+        
+        # Format the response with code blocks
+        formatted_response = format_code_blocks(response)
+        
+        # Add assistant response to database
+        db_manager.add_message(conversation_id, 'assistant', formatted_response, model)
+        return formatted_response
+    except Exception as e:
+        logger.error(f"Error generating AI response: {e}")
+        raise
+
+def start_generation_job(conversation_id, user_message, model):
+    """Queue AI response generation and return its job ID"""
+    job_id = secrets.token_urlsafe(16)
+    future = _gen_pool.submit(generate_and_save_response, conversation_id, user_message, model)
+    now = time.monotonic()
+    with generation_jobs_lock:
+        # Drop finished jobs nobody came back for
+        for stale_id in [jid for jid, (f, created) in generation_jobs.items()
+                         if f.done() and now - created > GEN_JOB_TTL]:
+            del generation_jobs[stale_id]
+        generation_jobs[job_id] = (future, now)
+    return job_id
+
+def get_generation_job(job_id):
+    """Return the future for a job, forgetting it once it has finished"""
+    with generation_jobs_lock:
+        job = generation_jobs.get(job_id)
+        if job is None:
+            return None
+        if job[0].done():
+            del generation_jobs[job_id]
+        return job[0]
+
 @app.route('/')
 def index():
     """Serve the main HTML page with conversation history"""
@@ -579,69 +1042,32 @@ def index():
     if not validate_model(selected_model):
         selected_model = DEFAULT_MODEL
     
-    # Check if we need to generate AI response
-    generate_response = request.args.get('generate_response', '0')
-    user_message = validate_input(request.args.get('user_message', ''))
-    
-    if generate_response == '1' and user_message:
-        # Generate AI response immediately
-        try:
-            # Get recent conversation context (last 2 messages for faster processing)
-            recent_messages = db_manager.get_conversation_messages(conversation_id, 2)
-            context = "\n".join([f"{msg['role']}: {msg['content']}" for msg in recent_messages])
-            
-            # Generate response with general conversational prompt
-            system_prompt = """You are a friendly and helpful AI assistant. Respond naturally to any question or topic. Be conversational, helpful, and engaging. You can discuss anything from casual conversation to technical topics."""
-            
-            # Include minimal conversation context in the prompt
-            full_prompt = f"{context}\n\nUser: {user_message}\nAssistant:"
-            
-            response = ollama_client.generate_response(full_prompt, selected_model, system_prompt)
-            
-            # Format the response with code blocks
-            formatted_response = format_code_blocks(response)
-            
-            # Add assistant response to database
-            db_manager.add_message(conversation_id, 'assistant', formatted_response, selected_model)
-            
-        except Exception as e:
-            logger.error(f"Error generating AI response: {e}")
-        
-        # Redirect to show the complete conversation
-        return redirect(f'/?conversation_id={conversation_id}&model={selected_model}#bottom')
+    # Keep showing the pending indicator until the background job finishes
+    job_id = request.args.get('job_id', '')
+    future = get_generation_job(job_id) if job_id else None
+    pending_job = job_id if future is not None and not future.done() else None
     
     # Get available models
     available_models = ollama_client.get_available_models()
     if not available_models:
         available_models = ['phi3:latest', 'deepseek-r1:1.5b', 'llama3:latest']
     
-    # Get conversation history from database (filtered by user)
-    messages = []
-    if conversation_id != 'default':
-        # Verify this conversation belongs to the current user
-        if db_manager.conversation_belongs_to_user(conversation_id, user_id):
-            messages = db_manager.get_conversation_messages(conversation_id)
-        else:
-            # If conversation doesn't belong to user, redirect to default
-            return redirect('/?conversation_id=default&model=' + selected_model)
-    else:
-        # For default conversation, get the most recent conversation for this user
-        user_conversations = db_manager.get_user_conversations(user_id)
-        if user_conversations:
-            # Use the most recent conversation
-            conversation_id = user_conversations[0]['conversation_id']
-            messages = db_manager.get_conversation_messages(conversation_id)
-    
-    # Read the HTML template
-    with open('index.html', 'r', encoding='utf-8') as f:
-        template_content = f.read()
-    
-    # Render the template with data
-    return render_template_string(template_content,
-                                conversation_id=conversation_id,
-                                selected_model=selected_model,
-                                available_models=available_models,
-                                messages=messages)
+    # Get conversation history from database (filtered by user). For the default
+    # conversation this resolves to the user's most recent one
+    context = db_manager.load_index_context(user_id, conversation_id)
+    if context is None:
+        # If conversation doesn't belong to user, redirect to default
+        return redirect('/?conversation_id=default&model=' + selected_model)
+    conversation_id = context['conversation_id']
+    messages = context['messages']
+    
+    # Render the template with data (Flask caches the compiled template)
+    return render_template('index.html',
+                           conversation_id=conversation_id,
+                           selected_model=selected_model,
+                           available_models=available_models,
+                           messages=messages,
+                           pending_job=pending_job)
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -659,6 +1085,8 @@ def login():
         if success:
             # Store the prefixed user ID in session for template compatibility
             session['user_id'] = f"auth_user_{user_id}"
+            # Record the user once per login rather than on every request
+            db_manager.get_or_create_user(f"auth_user_{user_id}", username)
             flash(f'Welcome back, {username}!', 'success')
             return redirect(url_for('index'))
         else:
@@ -666,9 +1094,7 @@ def login():
             return redirect(url_for('login'))
     
     # GET request - show login form
-    with open('login.html', 'r', encoding='utf-8') as f:
-        template_content = f.read()
-    return render_template_string(template_content)
+    return render_template('login.html')
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -692,7 +1118,7 @@ def register():
             return redirect(url_for('register'))
         
         # Basic email validation
-        if not re.match(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$', email):
+        if not _EMAIL_RE.fullmatch(email):
             flash('Please enter a valid email address', 'error')
             return redirect(url_for('register'))
         
@@ -706,9 +1132,7 @@ def register():
             return redirect(url_for('register'))
     
     # GET request - show registration form
-    with open('register.html', 'r', encoding='utf-8') as f:
-        template_content = f.read()
-    return render_template_string(template_content)
+    return render_template('register.html')
 
 @app.route('/logout')
 def logout():
@@ -726,9 +1150,7 @@ def profile():
         flash('User not found', 'error')
         return redirect(url_for('index'))
     
-    with open('profile.html', 'r', encoding='utf-8') as f:
-        template_content = f.read()
-    return render_template_string(template_content, user=current_user)
+    return render_template('profile.html', user=current_user)
 
 @app.route('/api/health')
 def health_check():
@@ -750,7 +1172,11 @@ def get_models():
 def get_conversations():
     """Get all conversation IDs for current user"""
     user_id = get_user_id()
-    conversations = db_manager.get_user_conversations(user_id)
+    # ?include_last=1 also returns each conversation's latest messages
+    if request.args.get('include_last') == '1':
+        conversations = db_manager.get_user_conversations_with_messages(user_id, CONVERSATION_PREVIEW_MESSAGES)
+    else:
+        conversations = db_manager.get_user_conversations(user_id)
     return jsonify({'conversations': conversations})
 
 @app.route('/api/conversations/<conversation_id>', methods=['GET'])
@@ -780,7 +1206,7 @@ def clear_all_conversations():
 def new_chat():
     """Start a new conversation"""
     user_id = get_user_id()
-    conversation_id = 'chat_' + str(int(time.time()))
+    conversation_id = new_conversation_id()
     db_manager.create_conversation(user_id, conversation_id)
     return redirect(f'/?conversation_id={conversation_id}')
 
@@ -795,7 +1221,7 @@ def clear_history():
 def chat():
     """Handle chat requests via form submission"""
     # Rate limiting
-    client_ip = request.remote_addr
+    client_ip = canon_ip(request.remote_addr or '')
     if not check_rate_limit(client_ip, max_requests=5, window_seconds=60):
         return redirect(f'/?conversation_id=default&model={DEFAULT_MODEL}&error=rate_limit_exceeded')
     
@@ -823,33 +1249,122 @@ def chat():
         
         # Create conversation if it doesn't exist
         if conversation_id == 'default':
-            conversation_id = 'chat_' + str(int(time.time()))
+            conversation_id = new_conversation_id()
             db_manager.create_conversation(user_id, conversation_id, model)
         
         # Add user message to database immediately
         db_manager.add_message(conversation_id, 'user', message)
         
-        # Redirect to show user message immediately, then generate AI response
-        return redirect(f'/?conversation_id={conversation_id}&model={model}&generate_response=1&user_message={message}#bottom')
+        # Generate AI response in the background and show the conversation while it runs
+        job_id = start_generation_job(conversation_id, message, model)
+        return redirect(f'/?conversation_id={conversation_id}&model={model}&job_id={job_id}#bottom')
         
     except Exception as e:
         logger.error(f"Error in chat endpoint: {e}")
         return redirect(f'/?conversation_id=default&model={DEFAULT_MODEL}&error=server_error#bottom')
 
 
+@app.route('/chat/poll/<job_id>')
+def chat_poll(job_id):
+    """Return the result of a background generation job"""
+    future = get_generation_job(job_id)
+    if future is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if not future.done():
+        return jsonify({'status': 'pending'}), 202
+    if future.exception() is not None:
+        return jsonify({'status': 'error', 'error': 'Failed to generate response'}), 500
+    return jsonify({'status': 'done', 'response': future.result()})
+
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Stream an AI response to the client as server-sent events"""
+    # Rate limiting
+    client_ip = canon_ip(request.remote_addr or '')
+    if not check_rate_limit(client_ip, max_requests=5, window_seconds=60):
+        return jsonify({'error': 'Rate limit exceeded'}), 429
+    
+    user_id = get_user_id()
+    data = request.get_json(silent=True) or request.form
+    
+    # Get and validate request data
+    message = validate_input(data.get('message', ''))
+    model = data.get('model', DEFAULT_MODEL)
+    conversation_id = data.get('conversation_id', 'default')
+    
+    if not message:
+        return jsonify({'error': 'Invalid message'}), 400
+    
+    if not validate_model(model):
+        model = DEFAULT_MODEL
+    
+    if not validate_conversation_id(conversation_id):
+        conversation_id = 'default'
+    
+    # Create conversation if needed, otherwise make sure it belongs to this user
+    if conversation_id == 'default':
+        conversation_id = new_conversation_id()
+        db_manager.create_conversation(user_id, conversation_id, model)
+    elif not db_manager.conversation_belongs_to_user(conversation_id, user_id):
+        return jsonify({'error': 'Conversation not found'}), 404
+    
+    full_prompt = build_chat_prompt(conversation_id, message)
+    
+    def generate():
+        chunks = []
+        pending = 0
+        last_flush = time.monotonic()
+        try:
+            for chunk in ollama_client.stream_response(full_prompt, model, SYSTEM_PROMPT):
+                if not chunk:
+                    continue
+                chunks.append(chunk)
+                pending += 1
+                
+                # Batch tokens into fewer, larger events
+                now = time.monotonic()
+                if pending >= STREAM_FLUSH_TOKENS or now - last_flush >= STREAM_FLUSH_INTERVAL:
+                    yield f"data: {json.dumps({'chunk': ''.join(chunks[-pending:])})}\n\n"
+                    pending = 0
+                    last_flush = now
+            
+            if pending:
+                yield f"data: {json.dumps({'chunk': ''.join(chunks[-pending:])})}\n\n"
+        finally:
+            # Save the user message and whatever reply was generated together, also when
+            # the client disconnected mid-stream
+            rows = [('user', message, None)]
+            formatted_response = format_code_blocks(''.join(chunks).strip())
+            if formatted_response:
+                rows.append(('assistant', formatted_response, model))
+            db_manager.add_messages(conversation_id, rows)
+        yield f"data: {json.dumps({'done': True, 'conversation_id': conversation_id})}\n\n"
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+
+# Encoded /api/status body and when it expires; replaced as one tuple so readers never see a mix
+STATUS_CACHE_TTL = 2
+_status_cache = (0.0, b'')
 
 @app.route('/api/status')
 def status():
     """Get server and Ollama status"""
-    is_connected = ollama_client.check_connection()
-    models = ollama_client.get_available_models() if is_connected else []
+    global _status_cache
+    expires, body = _status_cache
+    now = time.monotonic()
+    if now >= expires:
+        is_connected = ollama_client.check_connection()
+        models = ollama_client.get_available_models() if is_connected else []
+        
+        body = orjson.dumps({
+            'server_status': 'running',
+            'ollama_connected': is_connected,
+            'available_models': models,
+            'default_model': DEFAULT_MODEL
+        })
+        _status_cache = (now + STATUS_CACHE_TTL, body)
     
-    return jsonify({
-        'server_status': 'running',
-        'ollama_connected': is_connected,
-        'available_models': models,
-        'default_model': DEFAULT_MODEL
-    })
+    return Response(body, mimetype='application/json')
 
 @app.errorhandler(404)
 def not_found(error):
@@ -859,47 +1374,63 @@ def not_found(error):
 def internal_error(error):
     return jsonify({'error': 'Internal server error'}), 500
 
+# Static part of the startup banner, built once
+_ENDPOINTS_BANNER = "\n".join([
+    "=" * 50,
+    "🌐 Server will be available at: http://localhost:5000",
+    "📝 API endpoints:",
+    "   - GET  /api/health     - Health check",
+    "   - GET  /api/models     - List available models",
+    "   - POST /chat           - Send chat message",
+    "   - POST /api/chat/stream - Stream chat response (SSE)",
+    "   - GET  /chat/poll/<job_id> - Poll a background chat response",
+    "   - GET  /api/status     - Server status",
+    "   - GET  /api/conversations - List conversations",
+    "   - GET  /api/conversations/<id> - Get conversation",
+    "   - DELETE /api/conversations/<id> - Delete conversation",
+    "   - DELETE /api/conversations - Clear all conversations",
+    "=" * 50,
+])
+
+def write_banner(lines):
+    """Write the banner as UTF-8 in a single write, whatever the console encoding"""
+    sys.stdout.flush()
+    sys.stdout.buffer.write(("\n".join(lines) + "\n").encode('utf-8'))
+    sys.stdout.buffer.flush()
+
 def main():
     """Main function to run the server"""
-    print("🤖 AI Chatbot Server Starting...")
-    print("=" * 50)
+    lines = ["🤖 AI Chatbot Server Starting...", "=" * 50]
     
     # Initialize database
-    print("🗄️  Initializing database...")
+    lines.append("🗄️  Initializing database...")
     try:
         db_manager.init_database()
-        print("✅ Database initialized successfully")
+        lines.append("✅ Database initialized successfully")
     except Exception as e:
-        print(f"❌ Database initialization failed: {e}")
+        lines.append(f"❌ Database initialization failed: {e}")
+        write_banner(lines)
         return
     
     # Check Ollama connection
     if ollama_client.check_connection():
-        print("✅ Ollama server is running")
+        lines.append("✅ Ollama server is running")
         models = ollama_client.get_available_models()
         if models:
-            print(f"📦 Available models: {', '.join(models)}")
+            lines.append(f"📦 Available models: {', '.join(models)}")
         else:
-            print("⚠️  No models found. You may need to pull a model first.")
+            lines.append("⚠️  No models found. You may need to pull a model first.")
     else:
-        print("❌ Ollama server is not running")
-        print("   Please start Ollama first:")
-        print("   - Download from: https://ollama.ai/")
-        print("   - Run: ollama serve")
-        print("   - Pull a model: ollama pull llama2")
-    
-    print("=" * 50)
-    print("🌐 Server will be available at: http://localhost:5000")
-    print("📝 API endpoints:")
-    print("   - GET  /api/health     - Health check")
-    print("   - GET  /api/models     - List available models")
-    print("   - POST /chat           - Send chat message")
-    print("   - GET  /api/status     - Server status")
-    print("   - GET  /api/conversations - List conversations")
-    print("   - GET  /api/conversations/<id> - Get conversation")
-    print("   - DELETE /api/conversations/<id> - Delete conversation")
-    print("   - DELETE /api/conversations - Clear all conversations")
-    print("=" * 50)
+        lines.extend([
+            "❌ Ollama server is not running",
+            "   Please start Ollama first:",
+            "   - Download from: https://ollama.ai/",
+            "   - Run: ollama serve",
+            "   - Pull a model: ollama pull llama2",
+        ])
+    
+    lines.append(_ENDPOINTS_BANNER)
+    write_banner(lines)
     
     # Run the server
     app.run(
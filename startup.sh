@@ -21,7 +21,15 @@ if [ $? -eq 0 ]; then
     fi
     
     echo "🌐 Starting chatbot server..."
-    python server.py
+    # Gunicorn's threaded worker replaces Flask's development server. Scale with
+    # threads rather than workers, since background chat jobs live in-process
+    exec gunicorn server:app \
+        --worker-class gthread \
+        --workers "${WEB_WORKERS:-1}" \
+        --threads "${WEB_THREADS:-32}" \
+        --bind 0.0.0.0:5000 \
+        --keep-alive 30 \
+        --timeout 120
 else
     echo "❌ Failed to setup models. Exiting."
     exit 1
@@ -0,0 +1,201 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+_tmpdir = tempfile.mkdtemp()
+os.environ['DATABASE_PATH'] = os.path.join(_tmpdir, 'test.db')
+os.environ.setdefault('OLLAMA_BASE_URL', 'http://127.0.0.1:9')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orjson
+
+import db_utils
+import server
+
+
+class FlashedMessageTests(unittest.TestCase):
+    """Pages that render flashed (category, message) tuples from the session"""
+
+    def setUp(self):
+        self.client = server.app.test_client()
+
+    def test_failed_login_renders_flash(self):
+        response = self.client.post('/login', data={'username': 'nobody', 'password': 'wrong'},
+                                    follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Invalid username or password', response.data)
+
+    def test_login_then_profile_renders_flash(self):
+        self.client.post('/register', data={'username': 'flashuser', 'email': 'flash@example.com',
+                                            'password': 'secret1', 'confirm_password': 'secret1'})
+        response = self.client.post('/login', data={'username': 'flashuser', 'password': 'secret1'},
+                                    follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+
+        # The index page doesn't show flashes, so the login message is rendered here
+        response = self.client.get('/profile')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'flashuser', response.data)
+
+
+class JSONProviderTests(unittest.TestCase):
+    """jsonify() goes through ORJSONProvider.response"""
+
+    def test_jsonify_returns_orjson_bytes(self):
+        with server.app.app_context():
+            response = server.jsonify({'models': ['a', 'b'], 'count': 2})
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(response.data, orjson.dumps({'models': ['a', 'b'], 'count': 2}))
+
+    def test_jsonify_argument_forms(self):
+        # Flask packs several positional args into a list and keyword args into a dict
+        with server.app.app_context():
+            self.assertEqual(server.jsonify(1, 2).data, b'[1,2]')
+            self.assertEqual(server.jsonify(ok=True).data, b'{"ok":true}')
+
+    def test_api_route_uses_provider(self):
+        response = server.app.test_client().get('/api/conversations')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, orjson.dumps(response.get_json()))
+
+
+class StreamDisconnectTests(unittest.TestCase):
+    """/api/chat/stream saves the turn even if the client goes away mid-stream"""
+
+    def test_disconnect_saves_partial_reply(self):
+        def fake_stream(prompt, model, system_prompt=None):
+            yield 'Hello'
+            yield ' world'
+            yield ' never sent'
+
+        client = server.app.test_client()
+        with mock.patch.object(server.ollama_client, 'stream_response', fake_stream), \
+                mock.patch.object(server, 'STREAM_FLUSH_TOKENS', 1):
+            response = client.post('/api/chat/stream', json={'message': 'disconnect test'},
+                                   buffered=False)
+            chunks = iter(response.response)
+            self.assertIn(b'Hello', next(chunks))
+            response.close()
+
+        with sqlite3.connect(os.environ['DATABASE_PATH']) as conn:
+            conversation_id = conn.execute(
+                "SELECT conversation_id FROM messages WHERE content = 'disconnect test'").fetchone()[0]
+        messages = server.db_manager.get_conversation_messages(conversation_id)
+        self.assertEqual([(m['role'], m['content']) for m in messages],
+                         [('user', 'disconnect test'), ('assistant', 'Hello')])
+
+
+class MessageWriterTests(unittest.TestCase):
+    """The group-commit writer behind DatabaseManager.add_messages"""
+
+    def setUp(self):
+        self.db = server.DatabaseManager(os.path.join(tempfile.mkdtemp(), 'writer.db'))
+        self.addCleanup(self.db.close)
+        self.db.create_conversation('writer_user', 'chat_a')
+        self.db.create_conversation('writer_user', 'chat_b')
+
+    def _item(self, conversation_id, rows):
+        return {'conversation_id': conversation_id, 'rows': rows,
+                'done': server.threading.Event(), 'ok': False}
+
+    def test_add_messages_is_visible_after_return(self):
+        self.assertTrue(self.db.add_messages('chat_a', [('user', 'hi', None), ('assistant', 'hello', 'm')]))
+        self.assertEqual(self.db.get_recent_context('chat_a', 10), [('user', 'hi'), ('assistant', 'hello')])
+
+    def test_bad_item_does_not_fail_the_batch(self):
+        batch = [self._item('chat_a', [('user', 'first', None)]),
+                 self._item('chat_a', [('user', {'not': 'bindable'}, None)]),
+                 self._item('chat_b', [('user', 'second', None)])]
+        with self.assertLogs(server.logger, 'ERROR'):
+            self.db._commit_messages(batch)
+
+        self.assertEqual([item['ok'] for item in batch], [True, False, True])
+        self.assertTrue(all(item['done'].is_set() for item in batch))
+        self.assertEqual(self.db.get_recent_context('chat_a', 10), [('user', 'first')])
+        self.assertEqual(self.db.get_recent_context('chat_b', 10), [('user', 'second')])
+
+    def test_close_flushes_queued_messages(self):
+        items = [self._item('chat_a', [('user', f'queued {i}', None)]) for i in range(5)]
+        for item in items:
+            self.db._message_queue.put(item)
+        self.db.close()
+
+        self.assertTrue(all(item['ok'] for item in items))
+        with sqlite3.connect(self.db.db_path) as conn:
+            count = conn.execute("SELECT COUNT(*) FROM messages WHERE conversation_id = 'chat_a'").fetchone()[0]
+        self.assertEqual(count, 5)
+
+
+class DbUtilsTests(unittest.TestCase):
+    """Export and cleanup in db_utils against a scratch database"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        db_path = os.path.join(self.tmpdir, 'utils.db')
+        db = server.DatabaseManager(db_path)
+        self.db = db
+        self.addCleanup(db.close)
+        patcher = mock.patch.object(db_utils, 'DATABASE_PATH', db_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _export(self, user_id):
+        output_file = os.path.join(self.tmpdir, f'{user_id}.json')
+        with mock.patch('builtins.print'):
+            self.assertTrue(db_utils.export_user_data(user_id, output_file))
+        with open(output_file, 'rb') as f:
+            return orjson.loads(f.read())
+
+    def test_export_without_conversations(self):
+        self.db.get_or_create_user('auth_user_1', 'alone')
+        data = self._export('auth_user_1')
+        self.assertEqual(data['username'], 'alone')
+        self.assertEqual(data['conversations'], [])
+
+    def test_export_with_and_without_messages(self):
+        self.db.get_or_create_user('auth_user_2', 'talker')
+        self.db.create_conversation('auth_user_2', 'chat_empty')
+        self.db.create_conversation('auth_user_2', 'chat_full')
+        self.db.add_messages('chat_full', [('user', 'q "quoted"', None), ('assistant', 'a', 'm')])
+
+        data = self._export('auth_user_2')
+        conversations = {c['conversation_id']: c for c in data['conversations']}
+        self.assertEqual(set(conversations), {'chat_empty', 'chat_full'})
+        self.assertEqual(conversations['chat_empty']['messages'], [])
+        self.assertEqual([(m['role'], m['content']) for m in conversations['chat_full']['messages']],
+                         [('user', 'q "quoted"'), ('assistant', 'a')])
+
+    def test_cleanup_expires_only_old_anonymous_conversations(self):
+        old = "datetime('now', '-60 days')"
+        with sqlite3.connect(db_utils.DATABASE_PATH) as conn:
+            conn.execute(f"INSERT INTO users (user_id, username, last_active) VALUES ('auth_user_3', 'kept', {old})")
+            for user_id, conversation_id, updated_at in [
+                ('anon_user_1_1', 'chat_anon_old', old),
+                ('anon_user_1_1', 'chat_anon_new', 'CURRENT_TIMESTAMP'),
+                # '_' is a LIKE wildcard, so this only survives because it is escaped
+                ('anonXuserX1', 'chat_lookalike', old),
+                ('auth_user_3', 'chat_auth_old', old),
+            ]:
+                conn.execute(f"INSERT INTO conversations (user_id, conversation_id, updated_at) "
+                             f"VALUES (?, ?, {updated_at})", (user_id, conversation_id))
+                conn.execute("INSERT INTO messages (conversation_id, role, content) VALUES (?, 'user', 'x')",
+                             (conversation_id,))
+
+        with mock.patch('builtins.print'):
+            self.assertTrue(db_utils.cleanup_old_data(30))
+
+        with sqlite3.connect(db_utils.DATABASE_PATH) as conn:
+            conversations = {row[0] for row in conn.execute("SELECT conversation_id FROM conversations")}
+            messages = {row[0] for row in conn.execute("SELECT conversation_id FROM messages")}
+            users = {row[0] for row in conn.execute("SELECT user_id FROM users")}
+        self.assertEqual(conversations, {'chat_anon_new', 'chat_lookalike', 'chat_auth_old'})
+        self.assertEqual(messages, conversations)
+        self.assertIn('auth_user_3', users)
+
+
+if __name__ == '__main__':
+    unittest.main()